@@ -17,7 +17,7 @@
 import sys
 import asyncio
 import logging
-from kubernetes import client
+from kubernetes import client, watch
 
 CONFIGMAP_NAME = "jobs-emailer-configmap"
 CONFIGMAP_NS = "jobs-emailer"
@@ -30,14 +30,16 @@ CFG_DICT = {
     # Also, a low value could result in duplicated emails about similar events.
     # The default here is 6.5 minutes
     "task_compose_emails_loop_sleep": "400",
-    # send emails every this many seconds
+    # after sending task_send_emails_max emails, wait this many seconds before sending more
     "task_send_emails_loop_sleep": "30",
     # every time we send emails, send this many at max
     "task_send_emails_max": "10",
     # how long to block watching for pod events
     # not very important, but may further delay email delivery
     "task_watch_pods_timeout": "60",
-    # how often to read our configmap for reconfiguration
+    # how long to block watching for configmap events
+    "task_watch_configmap_timeout": "60",
+    # how long to wait before watching our configmap again after an API error
     "task_read_configmap_sleep": "10",
     # the domain emails will go to
     "email_to_domain": "toolsbeta.wmflabs.org",
@@ -49,19 +51,58 @@ CFG_DICT = {
     "smtp_server_fqdn": "mail.toolforge.org",
     # smtp server port to use for outbout emails
     "smtp_server_port": "465",
+    # timeout in seconds for blocking operations against the smtp server
+    "smtp_server_timeout": "30",
     # send emails for real? this should help you debug this stuff without harm
     "send_emails_for_real": "no",
     # print debug information into stdout
     "debug": "yes",
 }
 
+# CFG_DICT keys holding integer values
+CFG_INT_KEYS = [
+    "task_compose_emails_loop_sleep",
+    "task_send_emails_loop_sleep",
+    "task_send_emails_max",
+    "task_watch_pods_timeout",
+    "task_watch_configmap_timeout",
+    "task_read_configmap_sleep",
+    "smtp_server_port",
+    "smtp_server_timeout",
+]
+
+# CFG_DICT keys holding "yes"/"no" values
+CFG_BOOL_KEYS = [
+    "send_emails_for_real",
+    "debug",
+]
+
+
+def _retype(cfg_dict: dict) -> dict:
+    """Returns a typed copy of a config dictionary. Raises ValueError on invalid values."""
+    typed = dict(cfg_dict)
+
+    for key in CFG_INT_KEYS:
+        typed[key] = int(cfg_dict[key])
+
+    for key in CFG_BOOL_KEYS:
+        typed[key] = cfg_dict[key] == "yes"
+
+    return typed
+
+
+# typed copy of the CFG_DICT values above, so the task loops don't have to parse the same
+# strings over and over again. Keys not listed above are kept as strings. Only refreshed when
+# reconfiguring
+CFG_TYPED = _retype(CFG_DICT)
+
 
 def reconfigure_logging():
     logging_format = "%(asctime)s %(levelname)s: %(message)s"
     logging.basicConfig(format=logging_format, stream=sys.stdout, datefmt="%Y-%m-%d %H:%M:%S")
 
     logging_level = logging.DEBUG
-    if CFG_DICT["debug"] != "yes":
+    if not CFG_TYPED["debug"]:
         logging_level = logging.INFO
 
     logging.getLogger().setLevel(logging_level)
@@ -69,39 +110,72 @@ def reconfigure_logging():
 
 
 def reconfigure(configmap: dict):
-    for key in configmap.data:
-        if key not in CFG_DICT:
-            logging.warning(f"ignoring unknown config key '{key}' (doesn't have a previous value)")
-            continue
+    data = configmap.data or {}
+
+    unknown = data.keys() - CFG_DICT.keys()
+    if unknown:
+        logging.warning(
+            f"ignoring unknown config keys (don't have a previous value): {sorted(unknown)}"
+        )
 
-        CFG_DICT[key] = configmap.data[key]
+    known = data.keys() & CFG_DICT.keys()
+    if not known:
+        return
+
+    new_dict = {**CFG_DICT, **{key: data[key] for key in known}}
+    try:
+        new_typed = _retype(new_dict)
+    except ValueError as e:
+        logging.warning(f"invalid configuration: {e}. Will use previous config.")
+        return
+
+    # only update now that we know the new config is valid, so it is never half applied
+    CFG_DICT.update(new_dict)
+    CFG_TYPED.update(new_typed)
+
+    if "debug" in known:
+        reconfigure_logging()
 
-    reconfigure_logging()
     logging.info(f"new configuration: {CFG_DICT}")
 
 
-async def task_read_configmap():
-    corev1api = client.CoreV1Api()
-    last_seen_version = 0
+async def task_read_configmap(corev1api: client.CoreV1Api):
+    w = watch.Watch()
+    last_seen_version = None
 
+    # instead of polling, watch our configmap (and only ours) so we just reconfigure when it is
+    # created or modified. The initial stream without a resource version contains the current
+    # state of the configmap, which gives us the initial configuration
     while True:
         logging.debug("task_read_configmap() loop")
 
+        stream = w.stream(
+            corev1api.list_namespaced_config_map,
+            namespace=CONFIGMAP_NS,
+            field_selector=f"metadata.name={CONFIGMAP_NAME}",
+            timeout_seconds=CFG_TYPED["task_watch_configmap_timeout"],
+            resource_version=last_seen_version,
+        )
+
         try:
-            configmap = corev1api.read_namespaced_config_map(
-                name=CONFIGMAP_NAME, namespace=CONFIGMAP_NS
-            )
+            while True:
+                # the watch blocks on the network, run it in a different thread
+                event = await asyncio.to_thread(next, stream, None)
+                if event is None:
+                    break
+
+                if event["type"] in ["ADDED", "MODIFIED"]:
+                    reconfigure(event["object"])
+
+                last_seen_version = w.resource_version
         except client.exceptions.ApiException as e:
+            if e.status == 410:
+                logging.debug("configmap resource version too old, watching from scratch")
+                last_seen_version = None
+                continue
+
             logging.warning(
-                f"unable to query configmap {CONFIGMAP_NS}/{CONFIGMAP_NAME}: "
+                f"unable to watch configmap {CONFIGMAP_NS}/{CONFIGMAP_NAME}: "
                 f"{e.status} {e.reason}. Will use previous config."
             )
-            await asyncio.sleep(int(CFG_DICT["task_read_configmap_sleep"]))
-            continue
-
-        new_version = int(configmap.metadata.resource_version)
-        if new_version > last_seen_version:
-            last_seen_version = new_version
-            reconfigure(configmap)
-
-        await asyncio.sleep(int(CFG_DICT["task_read_configmap_sleep"]))
+            await asyncio.sleep(CFG_TYPED["task_read_configmap_sleep"])
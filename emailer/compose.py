@@ -16,11 +16,28 @@
 
 import asyncio
 import logging
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
 from dataclasses import dataclass
-from collections import deque
 import emailer.cfg as cfg
 from emailer.events import Cache, UserJobs
 
+# same for every email, no need to compose it every time
+EMAIL_FOOTER = (
+    "\n\n"
+    "If you requested 'filelog' for any of the jobs mentioned above, you may find "
+    "additional information about what happened in the associated log files. "
+    "Check them from Toolforge bastions as usual.\n"
+    "\n"
+    "You are receiving this email because:\n"
+    " 1) when the job was created, it was requested to send email notfications.\n"
+    " 2) you are listed as tool maintainer for this tool.\n"
+    "\n"
+    "Find help and more information in wikitech: https://wikitech.wikimedia.org/\n"
+    "\n"
+    "Thanks for your contributions to the Wikimedia movement.\n"
+)
+
 
 @dataclass(frozen=True)
 class Email:
@@ -31,19 +48,18 @@ class Email:
     from_addr: str
     body: str
 
-    def message(self) -> str:
-        """method to generate a message string suitable for smptlib.sendmail()."""
-        # headers
-        ret = ""
-        ret += f"Subject: {self.subject}\n"
-        ret += f"To: {self.to_addr}\n"
-        ret += f"From: {self.from_addr}"
-
-        # content
-        ret += "\n\n"
-        ret += self.body
+    def message(self) -> EmailMessage:
+        """method to generate a message suitable for smptlib.send_message()."""
+        msg = EmailMessage()
+        msg["Subject"] = self.subject
+        msg["To"] = self.to_addr
+        msg["From"] = self.from_addr
+        msg["Date"] = formatdate(localtime=True)
+        # pass the domain explicitly, otherwise make_msgid() resolves our own FQDN every time
+        msg["Message-ID"] = make_msgid(domain=self.from_addr.rpartition("@")[2])
+        msg.set_content(self.body)
 
-        return ret
+        return msg
 
 
 def _compose_subject(userjobs: UserJobs) -> str:
@@ -51,7 +67,8 @@ def _compose_subject(userjobs: UserJobs) -> str:
 
     jobcount = len(userjobs.jobs)
     if jobcount == 1:
-        subject += f"job {userjobs.jobs[0].name}"
+        job = next(iter(userjobs.jobs.values()))
+        subject += f"job {job.name}"
     else:
         subject += f"{jobcount} jobs"
 
@@ -59,54 +76,45 @@ def _compose_subject(userjobs: UserJobs) -> str:
 
 
 def compose_email(userjobs: UserJobs) -> Email:
-    addr_prefix = cfg.CFG_DICT["email_to_prefix"]
-    addr_domain = cfg.CFG_DICT["email_to_domain"]
+    addr_prefix = cfg.CFG_TYPED["email_to_prefix"]
+    addr_domain = cfg.CFG_TYPED["email_to_domain"]
     address = f"{addr_prefix}.{userjobs.username}@{addr_domain}"
     subject = _compose_subject(userjobs)
 
-    body = "We wanted to notify you about the activity of some jobs "
-    body += f"in the '{userjobs.username}' Toolforge tool.\n"
+    # build the body out of fragments and join them once, instead of copying a growing string
+    parts = ["We wanted to notify you about the activity of some jobs "]
+    parts.append(f"in the '{userjobs.username}' Toolforge tool.\n")
 
-    for job in userjobs.jobs:
+    for job in userjobs.jobs.values():
         eventcount = len(job.events)
-        body += f"\n* Job '{job.name}' ({job.type}) (emails: {job.emailsconfig}) "
-        body += f"had {eventcount} events:\n"
+        parts.append(f"\n* Job '{job.name}' ({job.type}) (emails: {job.emailsconfig}) ")
+        parts.append(f"had {eventcount} events:\n")
         for jobevent in job.events:
-            body += f"  -- {jobevent}\n"
-
-    body += "\n\n"
-    body += "If you requested 'filelog' for any of the jobs mentioned above, you may find "
-    body += "additional information about what happened in the associated log files. "
-    body += "Check them from Toolforge bastions as usual.\n"
-    body += "\n"
-    body += "You are receiving this email because:\n"
-    body += " 1) when the job was created, it was requested to send email notfications.\n"
-    body += " 2) you are listed as tool maintainer for this tool.\n"
-    body += "\n"
-    body += "Find help and more information in wikitech: https://wikitech.wikimedia.org/\n"
-    body += "\n"
-    body += "Thanks for your contributions to the Wikimedia movement.\n"
+            parts.append(f"  -- {jobevent}\n")
+
+    parts.append(EMAIL_FOOTER)
+    body = "".join(parts)
 
     # TODO: run the extra mile and include the last few log lines in the email?
 
     return Email(
-        from_addr=cfg.CFG_DICT["email_from_addr"], to_addr=address, subject=subject, body=body
+        from_addr=cfg.CFG_TYPED["email_from_addr"], to_addr=address, subject=subject, body=body
     )
 
 
-async def task_compose_emails(cache: Cache, emailq: deque):
+async def task_compose_emails(cache: Cache, emailq: asyncio.Queue):
     while True:
         logging.debug("task_compose_emails() loop")
-        before = len(emailq)
-
-        for userjobs in cache.cache:
-            emailq.append(compose_email(userjobs))
+        new = 0
 
-        after = len(emailq)
-        new = after - before
+        for userjobs in cache.drain():
+            # will block if the queue is full, until the send task catches up
+            await emailq.put(compose_email(userjobs))
+            new += 1
 
         if new > 0:
-            logging.info(f"{new} new pending emails in the queue, new total queue size: {after}")
-            cache.flush()
+            logging.info(
+                f"{new} new pending emails in the queue, new total queue size: {emailq.qsize()}"
+            )
 
-        await asyncio.sleep(int(cfg.CFG_DICT["task_compose_emails_loop_sleep"]))
+        await asyncio.sleep(cfg.CFG_TYPED["task_compose_emails_loop_sleep"])
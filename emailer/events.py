@@ -19,10 +19,16 @@ import logging
 import json
 from kubernetes import client, watch
 from dataclasses import dataclass, field
+from collections import deque
 from enum import Enum, auto
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple, FrozenSet, Iterator
 import emailer.cfg as cfg
 
+_log = logging.getLogger(__name__)
+
+# max number of events to keep per job, older ones are discarded
+JOB_EVENTS_MAX = 128
+
 
 class JobEventNotRelevant(Exception):
     """Exception that indicates that a JobEvent is not relevant."""
@@ -38,7 +44,7 @@ class ExpectedLabel:
 
     name: str
     required: bool
-    values: Optional[List[str]] = None
+    values: Optional[FrozenSet[str]] = None
 
 
 @dataclass(frozen=True)
@@ -59,6 +65,20 @@ class ExpectedLabels:
                     f"pod has wrong value in '{label.name}'. '{label.values}' vs '{pod_label}'"
                 )
 
+    def selector(self) -> str:
+        """Method to generate a k8s label selector matching the required labels."""
+        selectors = []
+        for label in self.labels:
+            if not label.required:
+                continue
+
+            if label.values:
+                selectors.append(f"{label.name} in ({','.join(sorted(label.values))})")
+            else:
+                selectors.append(label.name)
+
+        return ",".join(selectors)
+
 
 EXPECTED_LABELS = ExpectedLabels(
     labels=[
@@ -71,7 +91,7 @@ EXPECTED_LABELS = ExpectedLabels(
             # job type
             name="app.kubernetes.io/component",
             required=True,
-            values=["jobs", "cronjobs", "deployments"],
+            values=frozenset(["jobs", "cronjobs", "deployments"]),
         ),
         ExpectedLabel(
             # job name
@@ -86,12 +106,12 @@ EXPECTED_LABELS = ExpectedLabels(
         ExpectedLabel(
             name="app.kubernetes.io/managed-by",
             required=True,
-            values=["toolforge-jobs-framework"],
+            values=frozenset(["toolforge-jobs-framework"]),
         ),
         ExpectedLabel(
             name="toolforge",
             required=True,
-            values=["tool"],
+            values=frozenset(["tool"]),
         ),
     ]
 )
@@ -110,17 +130,22 @@ class JobEmailsConfig(Enum):
         return self.name.lower()
 
     @classmethod
-    def from_event(self, event):
-        """Returns a JobEmailsConfig from a k8s event dictionary."""
-        jobemailsconfig = event["metadata"]["labels"].get("jobs.toolforge.org/emails", "none")
-        if jobemailsconfig == "onfailure":
-            return JobEmailsConfig.ONFAILURE
-        if jobemailsconfig == "onfinish":
-            return JobEmailsConfig.ONFINISH
-        if jobemailsconfig == "all":
-            return JobEmailsConfig.ALL
+    def from_labels(cls, labels: dict):
+        """Returns a JobEmailsConfig from the labels of a k8s event dictionary."""
+        return _JOB_EMAILS_CONFIG_BY_LABEL.get(
+            labels.get("jobs.toolforge.org/emails"), JobEmailsConfig.NONE
+        )
+
+
+# defined outside the Enum, otherwise it would become a member of it
+_JOB_EMAILS_CONFIG_BY_LABEL = {
+    "onfailure": JobEmailsConfig.ONFAILURE,
+    "onfinish": JobEmailsConfig.ONFINISH,
+    "all": JobEmailsConfig.ALL,
+}
 
-        return JobEmailsConfig.NONE
+# label values of the email configs that actually result in emails being sent
+EMAILS_LABEL_VALUES = frozenset(str(c) for c in JobEmailsConfig if c != JobEmailsConfig.NONE)
 
 
 class JobType(Enum):
@@ -136,18 +161,17 @@ class JobType(Enum):
         return self.name.lower()
 
     @classmethod
-    def from_event(self, event: dict):
-        """Returns a JobType from a k8s event dictionary."""
-        jobtype = event["metadata"]["labels"].get("app.kubernetes.io/component", "none")
+    def from_labels(cls, labels: dict):
+        """Returns a JobType from the labels of a k8s event dictionary."""
+        return _JOB_TYPE_BY_LABEL.get(labels.get("app.kubernetes.io/component"), JobType.UNKNOWN)
 
-        if jobtype == "jobs":
-            return JobType.NORMAL
-        elif jobtype == "cronjobs":
-            return JobType.CRONJOB
-        elif jobtype == "deployments":
-            return JobType.CONTINUOUS
 
-        return JobType.UNKNOWN
+# defined outside the Enum, otherwise it would become a member of it
+_JOB_TYPE_BY_LABEL = {
+    "jobs": JobType.NORMAL,
+    "cronjobs": JobType.CRONJOB,
+    "deployments": JobType.CONTINUOUS,
+}
 
 
 class ContainerState(Enum):
@@ -163,7 +187,7 @@ class ContainerState(Enum):
         return self.name.lower()
 
 
-@dataclass()
+@dataclass(eq=False)
 class JobEvent:
     """Class to represent a Toolforge Kubernetes job event."""
 
@@ -171,25 +195,25 @@ class JobEvent:
     phase: Optional[str] = None
     container_state: Optional[ContainerState] = ContainerState.UNKNOWN
     exit_code: Optional[int] = None
-    start_timestamp: Optional[str] = field(compare=False, default=None)
-    stop_timestamp: Optional[str] = field(compare=False, default=None)
-    reason: Optional[str] = field(compare=False, default=None)
-    message: Optional[str] = field(compare=False, default=None)
-    original_event: dict = field(compare=False, default=None)
+    start_timestamp: Optional[str] = None
+    stop_timestamp: Optional[str] = None
+    reason: Optional[str] = None
+    message: Optional[str] = None
 
     @classmethod
     def from_event(cls, event: dict):
         """Builds a JobEvent object from a kubernetes event."""
+        status = event["status"]
         podname = event["metadata"]["name"]
-        phase = event["status"]["phase"]
+        phase = status["phase"]
 
         # https://github.com/kubernetes-client/python/blob/master/kubernetes/docs/V1ContainerState.md
-        statuses = event["status"].get("containerStatuses", None)
-        if statuses is not None and statuses[0] is not None:
-            containerstatus = statuses[0]
-            running_state = containerstatus["state"].get("running", None)
-            terminated_state = containerstatus["state"].get("terminated", None)
-            waiting_state = containerstatus["state"].get("waiting", None)
+        statuses = status.get("containerStatuses", None)
+        if statuses and statuses[0] is not None:
+            state = statuses[0]["state"]
+            running_state = state.get("running", None)
+            terminated_state = state.get("terminated", None)
+            waiting_state = state.get("waiting", None)
         else:
             running_state = None
             terminated_state = None
@@ -228,13 +252,26 @@ class JobEvent:
         common_args = dict(
             podname=podname,
             phase=phase,
-            original_event=event,
             container_state=container_state,
         )
         args = {**common_args, **extra_args}
 
         return cls(**args)
 
+    def key(self) -> tuple:
+        """Returns the fields that identify this event, the same ones used to compare events."""
+        return (self.podname, self.phase, self.container_state, self.exit_code)
+
+    def __eq__(self, other):
+        """Two events are the same if their identifying fields match."""
+        if not isinstance(other, JobEvent):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __hash__(self):
+        """Hash the identifying fields, so events can be used as dict keys."""
+        return hash(self.key())
+
     def __repr__(self):
         """String representation."""
         s = ""
@@ -273,13 +310,11 @@ class Job:
     name: str
     type: JobType
     emailsconfig: Optional[JobEmailsConfig] = JobEmailsConfig.NONE
-    events: List[JobEvent] = field(init=False, default_factory=list)
+    # used as an ordered set: chronological order for the email, and quick duplicate detection
+    events: Dict[JobEvent, None] = field(init=False, default_factory=dict)
 
     def _relevance_test(self, new_event: JobEvent) -> None:
         """Evaluates if a new event is worth storing as job event."""
-        if self.emailsconfig == JobEmailsConfig.NONE:
-            raise JobEventNotRelevant(f"job emails config is {self.emailsconfig}")
-
         if new_event in self.events:
             raise JobEventNotRelevant("we already have a similar event (duplicated)")
 
@@ -287,8 +322,8 @@ class Job:
             raise JobEventNotRelevant("this event has no meaningful information")
 
         if self.emailsconfig == JobEmailsConfig.ALL:
-            logging.debug(
-                f"user wants emails about all events on this job, caching event: {new_event}"
+            _log.debug(
+                "user wants emails about all events on this job, caching event: %s", new_event
             )
             return
 
@@ -296,8 +331,8 @@ class Job:
             self.emailsconfig == JobEmailsConfig.ONFINISH
             and new_event.container_state == ContainerState.TERMINATED
         ):
-            logging.debug(
-                f"user wants emails about onfinish events on this job, caching event: {new_event}"
+            _log.debug(
+                "user wants emails about onfinish events on this job, caching event: %s", new_event
             )
             return
 
@@ -306,8 +341,9 @@ class Job:
             and new_event.container_state == ContainerState.TERMINATED
             and new_event.exit_code != 0
         ):
-            logging.debug(
-                f"user wants emails about onfailure events on this job, caching event: {new_event}"
+            _log.debug(
+                "user wants emails about onfailure events on this job, caching event: %s",
+                new_event,
             )
             return
 
@@ -315,9 +351,18 @@ class Job:
 
     def add_event(self, event: dict) -> None:
         """Add an entry to the list of job events."""
+        # no need to decode the event at all in this case
+        if self.emailsconfig == JobEmailsConfig.NONE:
+            raise JobEventNotRelevant(f"job emails config is {self.emailsconfig}")
+
         new_event = JobEvent.from_event(event)
         self._relevance_test(new_event)
-        self.events.append(new_event)
+
+        if len(self.events) >= JOB_EVENTS_MAX:
+            # discard the oldest event
+            del self.events[next(iter(self.events))]
+
+        self.events[new_event] = None
 
     def __str__(self):
         """String representation."""
@@ -329,117 +374,173 @@ class UserJobs:
     """Class to represent all job events produced by an user."""
 
     username: str
-    jobs: List[Job] = field(init=False, default_factory=list)
+    # indexed by (name, type, emailsconfig)
+    jobs: Dict[Tuple[str, JobType, JobEmailsConfig], Job] = field(init=False, default_factory=dict)
 
-    def _get_or_create(self, event: dict) -> Job:
+    def _get_or_create(self, key: Tuple[str, JobType, JobEmailsConfig]) -> Job:
         """Get a previous cached job from this user or create a new one if none exists."""
-        jobname = event["metadata"]["labels"]["app.kubernetes.io/name"]
-        jobtype = JobType.from_event(event)
-        jobemailsconfig = JobEmailsConfig.from_event(event)
-
-        for job in self.jobs:
-            if job.name == jobname and job.type == jobtype and job.emailsconfig == jobemailsconfig:
-                return job
+        job = self.jobs.get(key, None)
+        if job is not None:
+            return job
 
+        jobname, jobtype, jobemailsconfig = key
         new_job = Job(name=jobname, type=jobtype, emailsconfig=jobemailsconfig)
         return new_job
 
-    def add_event(self, event: dict) -> None:
-        """Add an event to the list of kubernetes job events."""
-        job = self._get_or_create(event)
+    def add_event(self, event: dict, labels: dict) -> None:
+        """Add an event (and its already extracted labels) to the list of kubernetes job events."""
+        jobname = labels["app.kubernetes.io/name"]
+        jobtype = JobType.from_labels(labels)
+        jobemailsconfig = JobEmailsConfig.from_labels(labels)
+        key = (jobname, jobtype, jobemailsconfig)
+
+        job = self._get_or_create(key)
         job.add_event(event)
 
         # we just created this entry
-        if job not in self.jobs:
-            self.jobs.append(job)
+        if key not in self.jobs:
+            self.jobs[key] = job
 
 
 @dataclass
 class Cache:
     """Class to represent collected Toolforge Kubernetes job events."""
 
-    cache: List[UserJobs] = field(init=False, default_factory=list)
+    # indexed by username
+    cache: Dict[str, UserJobs] = field(init=False, default_factory=dict)
 
     def _get_or_create(self, username: str) -> UserJobs:
         """Get the user job events object from the cache, or create one if it doesn't exists."""
-        for userjobs in self.cache:
-            if userjobs.username == username:
-                return userjobs
+        userjobs = self.cache.get(username, None)
+        if userjobs is not None:
+            return userjobs
 
         new_userjobs = UserJobs(username)
         return new_userjobs
 
     def add_event(self, event: dict) -> None:
         """Add an event to the cache."""
-        username = event["metadata"]["labels"]["app.kubernetes.io/created-by"]
+        # read by all the layers below, so extract them just once
+        labels = event["metadata"]["labels"]
+        username = labels["app.kubernetes.io/created-by"]
         userjobs = self._get_or_create(username)
-        userjobs.add_event(event)
+        userjobs.add_event(event, labels)
 
         # we just created this entry
-        if userjobs not in self.cache:
-            self.cache.append(userjobs)
+        if username not in self.cache:
+            self.cache[username] = userjobs
 
     def flush(self) -> None:
         """Delete the cache."""
         self.cache.clear()
-        logging.debug("cache flushed")
+        _log.debug("cache flushed")
 
+    def drain(self) -> Iterator[UserJobs]:
+        """Empty the cache, yielding each user job events object as it is removed."""
+        # so each entry can be released as soon as the caller is done with it, instead of
+        # keeping the whole cache alive until the end of the iteration
+        pending = deque(self.cache.values())
+        self.flush()
 
-def event_early_filter(event: dict, event_type: str) -> None:
-    """Evaluate if a k8s pod event is interesting to the emailer, before any caching routine."""
-    name = event["metadata"]["name"]
-    namespace = event["metadata"]["namespace"]
-
-    logging.debug(f"evaluating event relevance for pod '{namespace}/{name}'")
+        while pending:
+            yield pending.popleft()
 
-    if not namespace.startswith("tool-"):
-        raise JobEventNotRelevant(f"not interested in in namespace '{namespace}'")
 
+def event_early_filter(event: dict, event_type: str) -> None:
+    """Evaluate if a k8s pod event is interesting to the emailer, before any caching routine."""
+    # checks are sorted from cheapest to most expensive, so we do the minimum amount of work
+    # to discard the events
     if event_type != "MODIFIED":
         raise JobEventNotRelevant(f"not interested in this type {event_type}")
 
-    if event["metadata"].get("deletion_timestamp", None) is not None:
+    metadata = event["metadata"]
+
+    # no need to check for 'tool-' namespaces here: the 'toolforge=tool' label is enforced
+    # server-side, see POD_LABEL_SELECTOR
+
+    if metadata.get("deletion_timestamp", None) is not None:
         raise JobEventNotRelevant("object being deleted")
 
-    phase = event["status"]["phase"]
-    # https://kubernetes.io/docs/concepts/workloads/pods/pod-lifecycle/#pod-phase
-    if phase not in ["Pending", "Running", "Succeeded", "Failed"]:
-        raise JobEventNotRelevant(f"pod phase not relevant: {phase}")
+    # pod phase is filtered server-side, see POD_FIELD_SELECTOR
 
     # ignore early some obvious discards by configuration
     # further filtering is done later when we decode and do the math to calculate if an
     # event matches the requested config
-    labels = event["metadata"]["labels"]
-    EXPECTED_LABELS.validate(labels)
+    labels = metadata["labels"]
     emails = labels.get("jobs.toolforge.org/emails", "none")
-    if emails == "none":
-        raise JobEventNotRelevant("user configuration requested no emails")
+    if emails not in EMAILS_LABEL_VALUES:
+        raise JobEventNotRelevant(f"user configuration requested no emails: '{emails}'")
+
+    EXPECTED_LABELS.validate(labels)
 
-    logging.debug("event seems relevant in the early filter")
+    _log.debug("event seems relevant in the early filter")
 
 
-async def task_watch_pods(cache: Cache):
-    corev1api = client.CoreV1Api()
+# let the API server discard as many uninteresting pod events as possible, so we don't have to
+# receive and decode them just to drop them in event_early_filter()
+POD_LABEL_SELECTOR = ",".join(
+    [
+        EXPECTED_LABELS.selector(),
+        f"jobs.toolforge.org/emails in ({','.join(sorted(EMAILS_LABEL_VALUES))})",
+    ]
+)
+# https://kubernetes.io/docs/concepts/workloads/pods/pod-lifecycle/#pod-phase
+POD_FIELD_SELECTOR = "status.phase!=Unknown"
+
+
+async def _pods_resource_version(corev1api: client.CoreV1Api) -> str:
+    """Get the current resource version of the pod list."""
+    # calls to the k8s API block on the network, so run them in a different thread to let the
+    # other tasks run in the meanwhile
+    podlist = await asyncio.to_thread(corev1api.list_pod_for_all_namespaces, limit=1)
+    return podlist.metadata.resource_version
+
+
+async def task_watch_pods(corev1api: client.CoreV1Api, cache: Cache):
     w = watch.Watch()
 
     # prepopulating resource version so the initial stream doesn't show us events since the
     # beginning of the history
-    last_seen_version = corev1api.list_pod_for_all_namespaces(limit=1).metadata.resource_version
+    last_seen_version = await _pods_resource_version(corev1api)
 
     # this outer loop is in theory not neccesary. But we are using a timeout in the stream watch
-    # because if no events happen (unlikely in a real toolforge) then the call will block waiting
-    # for events, preventing the email send routine from executing. The timeout unblocks the call
-    # but then we need to restart it, hence this outer loop
+    # to make sure we never wait forever on a stale connection if no events happen (unlikely in
+    # a real toolforge). The timeout unblocks the call but then we need to restart it, hence
+    # this outer loop
     while True:
-        logging.debug("task_watch_pods() loop")
-        # let the others routines run if they need to
-        await asyncio.sleep(0)
+        _log.debug("task_watch_pods() loop")
 
-        for event in w.stream(
+        stream = w.stream(
             corev1api.list_pod_for_all_namespaces,
-            timeout_seconds=int(cfg.CFG_DICT["task_watch_pods_timeout"]),
+            label_selector=POD_LABEL_SELECTOR,
+            field_selector=POD_FIELD_SELECTOR,
+            timeout_seconds=cfg.CFG_TYPED["task_watch_pods_timeout"],
             resource_version=last_seen_version,
-        ):
+            # get periodic updates of the resource version even if there are no relevant events,
+            # so we can resume the watch from a recent one
+            allow_watch_bookmarks=True,
+        )
+
+        while True:
+            try:
+                # wait for the next event in a different thread, same as above. This also lets
+                # other tasks run in between events, so no need to explicitly yield to them
+                event = await asyncio.to_thread(next, stream, None)
+            except client.exceptions.ApiException as e:
+                if e.status != 410:
+                    raise
+
+                # our resource version is too old, watch again from the current one
+                _log.warning(f"pod resource version {last_seen_version} too old: {e.reason}")
+                last_seen_version = await _pods_resource_version(corev1api)
+                break
+
+            if event is None:
+                break
+
+            if event["type"] == "BOOKMARK":
+                last_seen_version = event["raw_object"]["metadata"]["resourceVersion"]
+                continue
 
             raw_event_dict = event["raw_object"]
 
@@ -447,17 +548,11 @@ async def task_watch_pods(cache: Cache):
                 event_early_filter(raw_event_dict, event["type"])
                 cache.add_event(raw_event_dict)
             except KeyError as e:
-                logging.error(f"potential bug while reading the k8s JSON, missing key {e}")
-                logging.error("offending JSON follows:")
-                logging.error(json.dumps(event, sort_keys=True, indent=4))
-                pass
-            except JobEventNotRelevant as e:
-                logging.debug(f"ignoring job event: {e}")
-                pass
-            except JobEventLabel as e:
-                logging.debug(f"ignoring job event: {e}")
-                pass
+                _log.error(f"potential bug while reading the k8s JSON, missing key {e}")
+                _log.error("offending JSON follows:")
+                # only the raw dict, the 'object' in the event is a k8s model, not serializable
+                _log.error(json.dumps(raw_event_dict, sort_keys=True))
+            except (JobEventNotRelevant, JobEventLabel) as e:
+                _log.debug("ignoring job event: %s", e)
 
             last_seen_version = event["object"].metadata.resource_version
-            # let other tasks run if they need to
-            await asyncio.sleep(0)
@@ -17,9 +17,9 @@
 import asyncio
 import logging
 import traceback
-from typing import List
-from collections import deque
-from kubernetes import config
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+from kubernetes import client, config
 import emailer.cfg as cfg
 import emailer.events as events
 import emailer.send as send
@@ -31,8 +31,9 @@ from emailer.events import Cache
 #    * events are filtered out, we only care about certain events
 #    * if a relevant event happens, we extract the info and cache them
 #  2) task_compose_emails(): iterate the job event cache to compose actual emails and queue them
-#  3) task_send_emails(): every Y seconds, send queued emails, up to a given max
-#  4) we also read a configmap every X seconds, to allow reconfiguration without restarts
+#  3) task_send_emails(): as soon as emails are queued, send them in batches up to a given max,
+#     waiting Y seconds after each full batch
+#  4) we also watch a configmap, to allow reconfiguration without restarts
 #     which should help reduce the amount of lost emails
 #
 # The ultimate goal is to collapse per-user events into a single email, and send emails in
@@ -41,41 +42,54 @@ from emailer.events import Cache
 # This means an user may get a single email with reports about several events that happened to
 # several jobs.
 #
-# The emailq queue is just a normal FIFO queue.
+# The emailq queue is just a normal FIFO queue. It is bounded, so if emails can't be sent for a
+# while (i.e, SMTP server down) the compose task waits for the send task instead of piling up
+# emails in memory.
 
+# max number of emails in the queue
+EMAILQ_MAXSIZE = 1000
 
-async def cancel_all_tasks(tasks: List[asyncio.tasks.Task]) -> None:
+# threads for the blocking k8s API calls run via asyncio.to_thread() (SMTP has its own thread).
+# Each task only has one of them in flight at a time, so this is just a few plus some headroom
+THREAD_POOL_SIZE = 8
+
+
+async def cancel_all_tasks(tasks: Iterable[asyncio.tasks.Task]) -> None:
     """This function cancel all alive tasks, so we can gracefully shutdown the event loop."""
     for task in tasks:
-        if task.done():
-            continue
-
         task.cancel()
-        await asyncio.sleep(0)
 
+    await asyncio.gather(*tasks, return_exceptions=True)
 
-async def task_error_check(
-    loop: asyncio.events.AbstractEventLoop, tasks: List[asyncio.tasks.Task]
-) -> None:
-    """This task checks all main program tasks to see if they are alive."""
-    logging.debug("task_error_check()")
 
-    for task in tasks:
-        if task.done():
-            logging.error(f"{task}")
-            try:
-                task.result()
-            except Exception:
-                logging.error(traceback.format_exc())
+async def run_tasks(corev1api: client.CoreV1Api) -> None:
+    """Run all main program tasks, until one of them dies."""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="emailer")
+    )
 
-            await cancel_all_tasks(tasks)
-            logging.warning("cancelled all tasks, bye bye")
-            loop.stop()
-            return
+    cache = Cache()
+    emailq = asyncio.Queue(maxsize=EMAILQ_MAXSIZE)
 
-    # everything OK, reschedule myself to check again after some time
-    await asyncio.sleep(60)
-    loop.create_task(task_error_check(loop, tasks))
+    # the main program tasks
+    tasks = [
+        asyncio.create_task(cfg.task_read_configmap(corev1api)),
+        asyncio.create_task(events.task_watch_pods(corev1api, cache)),
+        asyncio.create_task(compose.task_compose_emails(cache, emailq)),
+        asyncio.create_task(send.task_send_emails(emailq)),
+    ]
+
+    # none of the tasks is supposed to ever return, so if one does, something went wrong
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        logging.error(f"{task}")
+        try:
+            task.result()
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    await cancel_all_tasks(pending)
+    logging.warning("cancelled all tasks, bye bye")
 
 
 def main():
@@ -85,29 +99,14 @@ def main():
 
     # TODO: proper auth
     config.load_incluster_config()
-
-    cache = Cache()
-    emailq = deque()
-    tasks = []
-
-    loop = asyncio.get_event_loop()
-
-    # the main program tasks
-    tasks.append(loop.create_task(cfg.task_read_configmap()))
-    tasks.append(loop.create_task(events.task_watch_pods(cache)))
-    tasks.append(loop.create_task(compose.task_compose_emails(cache, emailq)))
-    tasks.append(loop.create_task(send.task_send_emails(emailq)))
-
-    # the task that detects if we should die (if one of the main program tasks died)
-    loop.create_task(task_error_check(loop, tasks))
+    # shared by all tasks, so they use the same HTTP connection pool
+    corev1api = client.CoreV1Api()
 
     try:
-        loop.run_forever()
+        asyncio.run(run_tasks(corev1api))
     except KeyboardInterrupt:
         pass
 
-    loop.close()
-
 
 if __name__ == "__main__":
     main()
@@ -17,59 +17,201 @@
 import asyncio
 import logging
 import smtplib
-from collections import deque
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
 import emailer.cfg as cfg
 from emailer.compose import Email
 
+_log = logging.getLogger(__name__)
 
-def send_email(email: Email) -> None:
-    server = cfg.CFG_DICT["smtp_server_fqdn"]
-    port = cfg.CFG_DICT["smtp_server_port"]
+# only check that the SMTP connection is still alive if it was idle for longer than this, in seconds
+SMTP_IDLE_CHECK = 10
 
-    logging.info(f"Sending email FROM: {email.from_addr} TO: {email.to_addr} via {server}:{port}")
-    logging.debug(f"SUBJECT: {email.subject}")
-    logging.debug(f"BODY: {email.body}")
+# when there is nothing to send, log something every this many seconds to show we are still alive
+SEND_HEARTBEAT = 600
 
-    if cfg.CFG_DICT["send_emails_for_real"] != "yes":
-        logging.info("not sending email for real")
-        return
+# give up on the rest of a batch once this many emails failed because of the SMTP server, and they
+# are more than a third of the batch
+SEND_ABORT_MIN_FAILURES = 3
 
-    try:
+
+def _is_server_failure(e: Exception) -> bool:
+    """Whether an error sending an email is about the SMTP server, rather than about the email."""
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+
+    if isinstance(e, smtplib.SMTPResponseException):
+        # 4xx are transient errors, i.e, the server is busy or otherwise struggling
+        return 400 <= e.smtp_code < 500
+
+    if isinstance(e, smtplib.SMTPException):
+        # i.e, the recipient was refused. Note all SMTP exceptions are OSError too
+        return False
+
+    # network errors, timeouts
+    return isinstance(e, OSError)
+
+
+@dataclass
+class SMTPSender:
+    """Class to send emails, reusing the same SMTP connection for as long as it works."""
+
+    smtp: Optional[smtplib.SMTP] = field(init=False, default=None)
+    # the server the connection above is for. It can change when reconfiguring
+    server: Optional[Tuple[str, int]] = field(init=False, default=None)
+    # time.monotonic() of the last successful use of the connection
+    last_used: float = field(init=False, default=0.0)
+
+    def _check(self) -> None:
+        """Close the SMTP connection if it is no longer usable."""
+        if self.smtp is None:
+            return
+
+        if time.monotonic() - self.last_used < SMTP_IDLE_CHECK:
+            return
+
+        try:
+            # the server may have closed the connection since we last used it
+            self.smtp.noop()
+        except (smtplib.SMTPException, OSError) as e:
+            _log.debug("previous SMTP connection is not usable: %s", e)
+            self.close()
+
+    def _connect(self, server: str, port: int) -> smtplib.SMTP:
+        """Get a SMTP connection, reusing the previous one if possible."""
+        if self.smtp is not None and self.server == (server, port):
+            return self.smtp
+
+        self.close()
         # TODO: TLS support?
-        smtp = smtplib.SMTP(server, port)
-    except Exception as e:
-        logging.error(f"unable to contact SMTP server at {server}:{port}: {e}")
-        return
+        self.smtp = smtplib.SMTP(server, port, timeout=cfg.CFG_TYPED["smtp_server_timeout"])
+        self.server = (server, port)
+        return self.smtp
+
+    def close(self) -> None:
+        """Close the SMTP connection, if any."""
+        if self.smtp is not None:
+            try:
+                # tell the server we are done, if it is still listening
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+
+        self.smtp = None
+        self.server = None
+
+    def send(self, emails: List[Email]) -> None:
+        """Send a batch of emails."""
+        server = cfg.CFG_TYPED["smtp_server_fqdn"]
+        port = cfg.CFG_TYPED["smtp_server_port"]
+
+        for_real = cfg.CFG_TYPED["send_emails_for_real"]
+        if for_real:
+            # the connection may have been idle for a while since the previous batch
+            self._check()
+        else:
+            # checked once per batch, so we don't even connect to the SMTP server if not needed
+            _log.info("not sending emails for real")
+
+        failed = 0
+        for i, email in enumerate(emails):
+            # logged right before actually trying, so the logs don't claim emails that were never
+            # attempted
+            _log.info(
+                "Sending email FROM: %s TO: %s via %s:%s",
+                email.from_addr,
+                email.to_addr,
+                server,
+                port,
+            )
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("SUBJECT: %s", email.subject)
+                _log.debug("BODY: %s", email.body)
+
+            if not for_real:
+                continue
+
+            try:
+                smtp = self._connect(server, port)
+            except Exception as e:
+                _log.error(
+                    "unable to contact SMTP server at %s:%s: %s. Dropped %d emails",
+                    server,
+                    port,
+                    e,
+                    len(emails) - i,
+                )
+                return
+
+            try:
+                # this also takes care of the CRLF line endings required by SMTP
+                smtp.send_message(email.message())
+            except Exception as e:
+                _log.error(
+                    "unable to send email to %s via %s:%s: %s", email.to_addr, server, port, e
+                )
+                if isinstance(e, smtplib.SMTPServerDisconnected):
+                    # connect again for the next email
+                    self.close()
+                if not _is_server_failure(e):
+                    # no need to RSET the session, send_message() already does that
+                    continue
+            else:
+                self.last_used = time.monotonic()
+                _log.debug("sent email to %s via %s:%s!", email.to_addr, server, port)
+                continue
+
+            failed += 1
+            remaining = emails[i + 1 :]
+            if remaining and failed >= SEND_ABORT_MIN_FAILURES and failed * 3 > len(emails):
+                _log.error(
+                    "SMTP server at %s:%s failed for %d emails in this batch, giving up. "
+                    "Dropped %d emails to: %s",
+                    server,
+                    port,
+                    failed,
+                    len(remaining),
+                    ", ".join(email.to_addr for email in remaining),
+                )
+                return
+
+
+async def task_send_emails(emailq: asyncio.Queue):
+    # keeps the SMTP connection open between batches
+    sender = SMTPSender()
+    # all SMTP traffic happens in this single thread, so the connection is never used by two
+    # threads, and it doesn't take a slot from the default executor used by the other tasks
+    smtp_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+    loop = asyncio.get_running_loop()
 
     try:
-        smtp.sendmail(email.from_addr, email.to_addr, email.message())
-    except Exception as e:
-        smtp.close()
-        logging.error(f"unable to send email to {email.to_addr} via {server}:{port}: {e}")
-        return
-
-    smtp.close()
-    logging.debug(f"sent email to {email.to_addr} via {server}:{port}!")
-
-
-async def task_send_emails(emailq: deque):
-    sent = 0
-    while True:
-        logging.debug("task_send_emails() loop")
-        if len(emailq) == 0:
-            sent = 0
-            logging.debug("no emails to send")
-            await asyncio.sleep(int(cfg.CFG_DICT["task_send_emails_loop_sleep"]))
-            continue
-
-        # pop left because this is a FIFO queue
-        email = emailq.popleft()
-
-        # send email in a different thread so we don't block the general emailer loop here
-        await asyncio.to_thread(send_email, email)
-
-        sent += 1
-        if sent >= int(cfg.CFG_DICT["task_send_emails_max"]):
-            logging.warning(f"sent {sent} emails (max), waiting before sending more")
-            sent = 0
-            await asyncio.sleep(int(cfg.CFG_DICT["task_send_emails_loop_sleep"]))
+        while True:
+            # wait until there is something to send, then take whatever else is already queued
+            try:
+                batch = [await asyncio.wait_for(emailq.get(), timeout=SEND_HEARTBEAT)]
+            except asyncio.TimeoutError:
+                _log.info("no emails to send in the last %d seconds", SEND_HEARTBEAT)
+                continue
+
+            max_batch = cfg.CFG_TYPED["task_send_emails_max"]
+            while not emailq.empty() and len(batch) < max_batch:
+                batch.append(emailq.get_nowait())
+
+            # send emails in a different thread so we don't block the general emailer loop here
+            await loop.run_in_executor(smtp_thread, sender.send, batch)
+
+            # rate limit: only wait if we sent as many emails as allowed at once. Otherwise the
+            # queue was drained, and the next get() will already block until there is more to send
+            if len(batch) < max_batch:
+                continue
+
+            if not emailq.empty():
+                _log.warning("sent %d emails (max), waiting before sending more", len(batch))
+                # don't keep the connection idle during the whole wait
+                await loop.run_in_executor(smtp_thread, sender.close)
+
+            await asyncio.sleep(cfg.CFG_TYPED["task_send_emails_loop_sleep"])
+    finally:
+        smtp_thread.shutdown(wait=False)
@@ -11,6 +11,10 @@ from emailer.events import (  # noqa: E402,F401
     JobType,
     JobEmailsConfig,
     event_early_filter,
+    JOB_EVENTS_MAX,
+    POD_LABEL_SELECTOR,
 )
 
 from emailer.compose import Email, compose_email  # noqa: E402,F401
+
+from emailer.send import SMTPSender  # noqa: E402,F401
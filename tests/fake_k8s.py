@@ -1,44 +1,20 @@
 import os  # noqa: F401
 import sys  # noqa: F401
-import copy
-from typing import Generator
+from typing import Generator, Iterator
 
 from .context import JobType, JobEmailsConfig
 
+# k8s object type associated with each JobType
+_JOBTYPE_TO_K8S = {
+    JobType.NORMAL: "jobs",
+    JobType.CRONJOB: "cronjobs",
+    JobType.CONTINUOUS: "deployments",
+}
+
 
 class FakeK8sPodGenerator:
     """Helper class to generate fake k8s pod dictionaries."""
 
-    pod_template = {
-        "metadata": {
-            "namespace": "",
-            "labels": {
-                "app.kubernetes.io/managed-by": "toolforge-jobs-framework",
-                "app.kubernetes.io/created-by": "",
-                "app.kubernetes.io/component": "",
-                "app.kubernetes.io/name": "",
-                "jobs.toolforge.org/emails": "",
-                "toolforge": "tool",
-            },
-            "name": "",
-        },
-        "status": {
-            "phase": "Succeeded",
-            "containerStatuses": [
-                {"state": {}},
-            ],
-        },
-    }
-
-    def _job_type_to_k8s_type(jobtype: JobType):
-        """Translate a JobType to the associated k8s object type."""
-        if jobtype == JobType.NORMAL:
-            return "jobs"
-        if jobtype == JobType.CRONJOB:
-            return "cronjobs"
-        if jobtype == JobType.CONTINUOUS:
-            return "deployments"
-
     def new(
         namespace: str = "tool-test-account",
         account: str = "test-account",
@@ -55,16 +31,6 @@ class FakeK8sPodGenerator:
         stop_time: str = "20220307 14:49:10 UTC",
     ) -> dict:
         """Creates a new fake k8s pod dictionary."""
-        obj = copy.deepcopy(FakeK8sPodGenerator.pod_template)
-        obj["metadata"]["namespace"] = namespace
-        obj["metadata"]["name"] = name
-        obj["metadata"]["labels"]["app.kubernetes.io/created-by"] = account
-        _component = FakeK8sPodGenerator._job_type_to_k8s_type(component)
-        obj["metadata"]["labels"]["app.kubernetes.io/component"] = _component
-        obj["metadata"]["labels"]["app.kubernetes.io/name"] = job_name
-        obj["metadata"]["labels"]["jobs.toolforge.org/emails"] = f"{job_emails}"
-        obj["status"]["phase"] = phase
-
         status = dict()
         if container_status == "waiting":
             status["reason"] = reason
@@ -78,10 +44,28 @@ class FakeK8sPodGenerator:
             status["started_at"] = start_time
             status["finished_at"] = stop_time
 
-        # only one container per job
-        obj["status"]["containerStatuses"][0]["state"][container_status] = status
-
-        return obj
+        # built from scratch every time, so callers are free to modify the returned dictionary
+        return {
+            "metadata": {
+                "namespace": namespace,
+                "labels": {
+                    "app.kubernetes.io/managed-by": "toolforge-jobs-framework",
+                    "app.kubernetes.io/created-by": account,
+                    "app.kubernetes.io/component": _JOBTYPE_TO_K8S.get(component),
+                    "app.kubernetes.io/name": job_name,
+                    "jobs.toolforge.org/emails": str(job_emails),
+                    "toolforge": "tool",
+                },
+                "name": name,
+            },
+            "status": {
+                "phase": phase,
+                # only one container per job
+                "containerStatuses": [
+                    {"state": {container_status: status}},
+                ],
+            },
+        }
 
     def phase_ok_sequence(
         account: str = "mytool",
@@ -161,7 +145,7 @@ class FakeK8sPodGenerator:
         )
         yield finish_event
 
-    def multiple_sequence(n: int = 3) -> Generator[dict, dict, dict]:
+    def multiple_sequence(n: int = 3) -> Iterator[dict]:
         """Returns multiple fake k8s pod dictionaries in sequences."""
         tested_jobtypes = [JobType.NORMAL, JobType.CRONJOB, JobType.CONTINUOUS]
         tested_emailconf = [
@@ -169,22 +153,15 @@ class FakeK8sPodGenerator:
             JobEmailsConfig.ONFAILURE,
             JobEmailsConfig.ALL,
         ]
-        events = []
-
         for i in range(n):
             for j in range(n):
                 account = f"mytool-{i}"
                 jobname = f"{account}-job-{j}"
                 for jobtype in tested_jobtypes:
                     for emails in tested_emailconf:
-                        for event in FakeK8sPodGenerator.phase_ok_sequence(
+                        yield from FakeK8sPodGenerator.phase_ok_sequence(
                             account=account, job_name=jobname, emails=emails, component=jobtype
-                        ):
-                            events.append(event)
-
-                        for event in FakeK8sPodGenerator.phase_failed_sequence(
+                        )
+                        yield from FakeK8sPodGenerator.phase_failed_sequence(
                             account=account, job_name=jobname, emails=emails, component=jobtype
-                        ):
-                            events.append(event)
-
-        return events
+                        )
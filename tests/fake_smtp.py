@@ -0,0 +1,37 @@
+import smtplib
+
+
+class FakeSMTP:
+    """Fake smtplib.SMTP, recording what it was asked to do instead of talking to a server."""
+
+    # set by the tests:
+    # recipient address -> exception to raise when sending to it
+    errors = {}
+    # whether connecting fails
+    unreachable = False
+
+    # checked by the tests
+    connections = 0
+    sent = []
+
+    def __init__(self, host: str, port: int, timeout: int = None):
+        if FakeSMTP.unreachable:
+            raise ConnectionRefusedError("fake connection refused")
+
+        FakeSMTP.connections += 1
+
+    def noop(self):
+        return (250, b"OK")
+
+    def send_message(self, msg):
+        error = FakeSMTP.errors.get(msg["To"])
+        if error is not None:
+            raise error
+
+        FakeSMTP.sent.append(msg["To"])
+
+    def quit(self):
+        raise smtplib.SMTPServerDisconnected("fake server already gone")
+
+    def close(self):
+        pass
@@ -1,7 +1,14 @@
 import os  # noqa: F401
 import sys  # noqa: F401
 import pytest
-from tests.context import Cache, JobEmailsConfig, event_early_filter, JobEventNotRelevant
+from tests.context import (
+    Cache,
+    JobEmailsConfig,
+    event_early_filter,
+    JobEventNotRelevant,
+    JOB_EVENTS_MAX,
+    POD_LABEL_SELECTOR,
+)
 
 from tests.fake_k8s import FakeK8sPodGenerator
 
@@ -63,6 +70,22 @@ def test_cache_delete_multiple():
     assert len(cache.cache) == 0
 
 
+def test_cache_drain():
+    """Verify the cache is left empty after draining it."""
+    cache = Cache()
+
+    for account in ["tool1", "tool2"]:
+        event = FakeK8sPodGenerator.new(
+            account=account, phase="Running", job_emails=JobEmailsConfig.ALL
+        )
+        cache.add_event(event)
+    assert len(cache.cache) == 2
+
+    usernames = [userjobs.username for userjobs in cache.drain()]
+    assert usernames == ["tool1", "tool2"]
+    assert len(cache.cache) == 0
+
+
 def test_cache_repeated_event():
     """Verify the cache detects (and rejects) repeated events."""
     cache = Cache()
@@ -73,9 +96,12 @@ def test_cache_repeated_event():
     cache.add_event(event)
     assert len(cache.cache) == 1
 
-    for userjobs in cache.cache:
+    with pytest.raises(JobEventNotRelevant, match=r".*duplicated.*"):
+        cache.add_event(event)
+
+    for userjobs in cache.cache.values():
         assert len(userjobs.jobs) == 1
-        for job in userjobs.jobs:
+        for job in userjobs.jobs.values():
             assert len(job.events) == 1
 
 
@@ -91,15 +117,34 @@ def test_cache_seq_ok():
         cache.add_event(event)
         assert len(cache.cache) == 1  # same account, same job
 
-    for userjobs in cache.cache:
+    for userjobs in cache.cache.values():
         if userjobs.username == username:
             assert len(userjobs.jobs) == 1
 
-            for job in userjobs.jobs:
+            for job in userjobs.jobs.values():
                 if job.name == jobname:
                     assert len(job.events) == 3
 
 
+def test_cache_job_events_max():
+    """Verify the cache keeps a bounded amount of events per job."""
+    cache = Cache()
+
+    for i in range(JOB_EVENTS_MAX + 10):
+        event = FakeK8sPodGenerator.new(
+            name=f"pod-{i}",
+            phase="Running",
+            container_status="running",
+            job_emails=JobEmailsConfig.ALL,
+        )
+        cache.add_event(event)
+
+    for userjobs in cache.cache.values():
+        for job in userjobs.jobs.values():
+            assert len(job.events) == JOB_EVENTS_MAX
+            assert next(iter(job.events)).podname == "pod-10"
+
+
 def test_cache_multiple_seq():
     """Verify the cache can work with multiple evens for different jobs."""
     cache = Cache()
@@ -114,10 +159,10 @@ def test_cache_multiple_seq():
 
     assert len(cache.cache) == n
 
-    for userjobs in cache.cache:
+    for userjobs in cache.cache.values():
         print(f"user: {userjobs.username}, jobs: {len(userjobs.jobs)}")
         assert len(userjobs.jobs) == n * 9  # magic number, per multiple_sequence() implementation
-        for job in userjobs.jobs:
+        for job in userjobs.jobs.values():
             print(f"job {job.name} ({job.type} {job.emailsconfig}) events: {len(job.events)}")
             if job.emailsconfig == JobEmailsConfig.ONFAILURE:
                 assert len(job.events) == 2  # magic number again
@@ -127,6 +172,20 @@ def test_cache_multiple_seq():
                 assert len(job.events) == 4  # magic number again
 
 
+def test_pod_label_selector():
+    """Verify the server-side label selector matches exactly the pods we are interested in."""
+    assert POD_LABEL_SELECTOR == ",".join(
+        [
+            "app.kubernetes.io/component in (cronjobs,deployments,jobs)",
+            "app.kubernetes.io/name",
+            "app.kubernetes.io/created-by",
+            "app.kubernetes.io/managed-by in (toolforge-jobs-framework)",
+            "toolforge in (tool)",
+            "jobs.toolforge.org/emails in (all,onfailure,onfinish)",
+        ]
+    )
+
+
 def test_event_early_filter_del_timestmp():
     """Verify the early filter function works."""
     event = FakeK8sPodGenerator.new(job_emails=JobEmailsConfig.ALL)
@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+from tests.context import emailer
+
+
+def test_reconfigure_invalid_value():
+    """Verify an invalid configmap value leaves the previous config untouched."""
+    cfg = emailer.cfg
+    previous_dict = dict(cfg.CFG_DICT)
+    previous_typed = dict(cfg.CFG_TYPED)
+
+    configmap = SimpleNamespace(
+        data={"task_send_emails_max": "x5", "send_emails_for_real": "yes", "smtp_server_port": "25"}
+    )
+    cfg.reconfigure(configmap)
+
+    assert cfg.CFG_DICT == previous_dict
+    assert cfg.CFG_TYPED == previous_typed
+    assert cfg.CFG_TYPED["send_emails_for_real"] is False
@@ -11,6 +11,20 @@ def test_email_basic():
     assert email.message
 
 
+def test_email_message():
+    """Verify the generated message has the expected headers and body."""
+    email = Email(
+        subject="subject", to_addr="to@example.com", from_addr="from@example.com", body="body"
+    )
+    message = email.message()
+    assert message["Subject"] == "subject"
+    assert message["To"] == "to@example.com"
+    assert message["From"] == "from@example.com"
+    assert message["Date"]
+    assert message["Message-ID"].endswith("@example.com>")
+    assert message.get_content() == "body\n"
+
+
 def test_email_compose():
     """Basic compose test."""
     cache = Cache()
@@ -18,7 +32,7 @@ def test_email_compose():
     cache.add_event(FakeK8sPodGenerator.new(phase="Running", job_emails=JobEmailsConfig.ALL))
     assert len(cache.cache) == 1
 
-    for userjobs in cache.cache:
+    for userjobs in cache.cache.values():
         email = compose_email(userjobs)
         assert email
         assert email.message
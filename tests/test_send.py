@@ -0,0 +1,83 @@
+import smtplib
+import pytest
+from tests.context import emailer, Email, SMTPSender
+from tests.fake_smtp import FakeSMTP
+
+
+@pytest.fixture
+def fake_smtp(monkeypatch):
+    """Send emails for real, but to a fresh FakeSMTP."""
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(FakeSMTP, "errors", {})
+    monkeypatch.setattr(FakeSMTP, "unreachable", False)
+    monkeypatch.setattr(FakeSMTP, "connections", 0)
+    monkeypatch.setattr(FakeSMTP, "sent", [])
+    monkeypatch.setitem(emailer.cfg.CFG_TYPED, "send_emails_for_real", True)
+    return FakeSMTP
+
+
+def _emails(n: int) -> list:
+    return [
+        Email(
+            subject="subject", to_addr=f"to{i}@example.com", from_addr="from@example.com", body=""
+        )
+        for i in range(n)
+    ]
+
+
+def test_send_not_for_real(fake_smtp, monkeypatch):
+    """Verify no SMTP connection is made when not sending emails for real."""
+    monkeypatch.setitem(emailer.cfg.CFG_TYPED, "send_emails_for_real", False)
+    SMTPSender().send(_emails(2))
+
+    assert fake_smtp.connections == 0
+    assert fake_smtp.sent == []
+
+
+def test_send_reuses_connection(fake_smtp):
+    """Verify several batches are sent over the same SMTP connection."""
+    sender = SMTPSender()
+    sender.send(_emails(2))
+    sender.send(_emails(3))
+
+    assert fake_smtp.connections == 1
+    assert len(fake_smtp.sent) == 5
+
+
+def test_send_reconnects(fake_smtp):
+    """Verify the sender connects again after the server disconnects, and keeps sending."""
+    fake_smtp.errors["to1@example.com"] = smtplib.SMTPServerDisconnected("fake disconnect")
+    SMTPSender().send(_emails(3))
+
+    assert fake_smtp.connections == 2
+    assert fake_smtp.sent == ["to0@example.com", "to2@example.com"]
+
+
+def test_send_recipient_refused(fake_smtp):
+    """Verify a refused recipient doesn't affect the other emails in the batch."""
+    refused = {"to0@example.com": (550, b"fake no such user")}
+    fake_smtp.errors["to0@example.com"] = smtplib.SMTPRecipientsRefused(refused)
+    SMTPSender().send(_emails(2))
+
+    assert fake_smtp.sent == ["to1@example.com"]
+
+
+def test_send_aborts_batch(fake_smtp, caplog):
+    """Verify the sender gives up on a batch once the server failed for too many emails."""
+    for i in range(3):
+        fake_smtp.errors[f"to{i}@example.com"] = smtplib.SMTPSenderRefused(
+            421, b"fake busy", "from@example.com"
+        )
+    SMTPSender().send(_emails(6))
+
+    assert fake_smtp.sent == []
+    assert "Dropped 3 emails" in caplog.text
+
+
+def test_send_unreachable(fake_smtp, caplog):
+    """Verify the sender logs the whole batch as dropped if it can't connect."""
+    fake_smtp.unreachable = True
+    SMTPSender().send(_emails(2))
+
+    assert fake_smtp.sent == []
+    assert "Dropped 2 emails" in caplog.text